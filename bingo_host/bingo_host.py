@@ -1,28 +1,64 @@
 from socket import *
-import pickle
+import os
+import sys
 import time
 import random
 import threading
 
+# The wire format is shared with the players
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "shared"))
+from bingo_protocol import BingoCard, DrawLog, FrameReader, encode_frame, send_frames, send_message
+
+# Compact record of a registered player
+# The socket, frame reader, pending frames and bingo card of the player are kept
+# on the record so that a connection can be mapped to its player with a single dictionary lookup
+class PlayerRecord:
+    __slots__ = ("conn", "reader", "pending", "address", "client_port", "server_port", "name", "card")
+
+    def __init__(self, conn, reader, address, client_port, server_port, name, card=None):
+        self.conn = conn
+        self.reader = reader
+        self.pending = []
+        self.address = address
+        self.client_port = client_port
+        self.server_port = server_port
+        self.name = name
+        self.card = card
+
+    # Wire format of the record, sent to the players in accept_player and start_message
+    def as_tuple(self):
+        return (self.address, self.client_port, self.server_port, self.name)
+
+    def __repr__(self):
+        return f"PlayerRecord({self.name!r}, {self.address}:{self.server_port})"
+
 # The bingo host class
 class BingoHost:
     def __init__(self):
         self.host = ""
         self.port = 65432
-        self.socket = socket(AF_INET, SOCK_STREAM)
+        self.socket = self.create_socket()
+        # Adjust the number below to change the number of players required to start the game
+        self.required_players = 2
         self.connections = []
         self.players = []
+        self.player_by_conn = {}
         self.numbers = []
-        self.drawn_numbers = []
+        self.drawn_numbers = DrawLog()
         self.bingo = None
-        self.bingo_cards = []
+        self.bingo_cards = {}
         self.registration_open = False
         self.game_ongoing = False
         self.consensus = {}
         self.send_lock = threading.Lock()
+        self.frame_lock = threading.Lock()
         self.bingo_shouted_event = threading.Event()  # Initialize event flag
         self.launch()
 
+    # Creates the listening socket of the host
+    def create_socket(self):
+        return socket(AF_INET, SOCK_STREAM)
+
     # Initialises a new game
     # Resets all game variables and generates a new set of numbers
     def initialise_new_game(self):
@@ -30,8 +66,8 @@ class BingoHost:
         self.socket.listen()
         self.numbers = list(range(1, 75))
         random.shuffle(self.numbers)
-        self.drawn_numbers = []
-        self.bingo_cards = []
+        self.drawn_numbers = DrawLog()
+        self.bingo_cards = {}
         self.registration_open = True
         self.game_ongoing = False
         self.consensus = {}
@@ -44,53 +80,63 @@ class BingoHost:
             # Accept new connections from players
             conn, addr = self.socket.accept()
             self.add_player(conn, addr)
-            # Adjust the number below to change the number of players required to start the game
             # todo: registration round open for a certain time, then start the game if enough players have registered
-            if len(self.players) == 2:
+            if len(self.players) == self.required_players:
                 self.registration_open = False
         self.start_game()
 
     # Adds a new player to the game and sends them a bingo card
     def add_player(self, conn, addr):
-        self.connections.append(conn)
-        data = conn.recv(1024)
-        data = pickle.loads(data)
+        reader = FrameReader(conn)
+        data = reader.recv_message()
         if data["type"] == "register": 
-            player_data = data["player"]
-            player = {
-                "address": addr[0], 
-                "client_port": addr[1], 
-                "server_port": player_data["server_port"], 
-                "name": player_data["name"],
-                "hit_numbers": player_data["hit_numbers"]
-            }
-            print("Received registration from player: ", player)
-            self.players.append(player)
-            # Generate and send a new bingo card to the connected player
-            bingo_card = self.generate_bingo_card()
-            print("Sending bingo card to player: ", bingo_card)
-            conn.sendall(pickle.dumps({
-                "type": "accept_player", 
-                "card": bingo_card, 
-                "player": player
-            }))
-
+            self.register_player(conn, reader, addr, data)
             # Wait for acknowledgement from the player
             self.wait_for_response(conn, message_type="accept_player", response_type="ack")
             print(f"Connected by {addr}")
 
+    # Stores the player from a registration message and sends them a new bingo card
+    def register_player(self, conn, reader, addr, data):
+        player = PlayerRecord(conn, reader, addr[0], addr[1], data["server_port"], data["name"])
+        print("Received registration from player: ", player)
+        self.connections.append(conn)
+        self.players.append(player)
+        self.player_by_conn[conn] = player
+        # Generate and send a new bingo card to the connected player
+        player.card = self.generate_bingo_card()
+        print("Sending bingo card to player: ", player.card.rows)
+        with self.frame_lock:
+            send_message(conn, {
+                "type": "accept_player", 
+                "card": player.card.rows, 
+                "player": player.as_tuple()
+            })
+        return player
+
     # Method to send a message to all players
+    # The message is encoded once and the same frame is queued for every player
+    # If flush is False the frame stays queued and is sent together with the next flushed message
     # If response_type is not None, waits for response from all players
     # consider multicasting?
-    def send_message_to_players(self, message, response_type=None):
-        for conn in self.connections:
-            conn.sendall(pickle.dumps(message))
+    def send_message_to_players(self, message, response_type=None, flush=True):
+        frame = encode_frame(message)
+        with self.frame_lock:
+            for player in self.players:
+                player.pending.extend(frame)
+            if flush:
+                self.flush_pending_frames()
 
         if response_type is not None:
             # Wait for response from all players
             with self.send_lock:
                 self.wait_for_response_from_all(message_type=message["type"], response_type=response_type)
 
+    # Sends the queued frames of every player, one vectored write per player
+    # Must be called with frame_lock held
+    def flush_pending_frames(self):
+        for player in self.players:
+            send_frames(player.conn, player.pending)
+
     # Listens for response from a single player, sets response_received to true if a response is received
     # Removes the player from the game if no response received in time
     def wait_for_response(self, conn, message_type, response_type):
@@ -100,10 +146,10 @@ class BingoHost:
         retries = 3
         response_received = False
         print(f"Waiting for response from {conn.getpeername()} for {message_type}...")
+        reader = self.player_by_conn[conn].reader
         while retries > 0 and not response_received:
             try:
-                data = conn.recv(1024)
-                data = pickle.loads(data)
+                data = reader.recv_message()
                 # Handle acknowledgement
                 if response_type == "ack" and data["type"] == "ack":
                     print(f"Received acknowledgement from {conn.getpeername()} for {message_type}")
@@ -133,36 +179,34 @@ class BingoHost:
 
     # Removes a player from the game
     def remove_player(self, conn):
-        # Send one more message to the player to let them know they're being removed, just in case
-        conn.sendall(pickle.dumps({
-            "type": "end_message", 
-            "content": "You have been removed from the game due to inactivity."
-        }))
-        # Find the player in the list of players
-        player = next((player for player in self.players if player["address"] == conn.getpeername()[0]), None)  
-        # Remove the player from the list of players and close the connection
-        if player is not None:
-            self.players.remove(player)
-        self.connections.remove(conn)
-        conn.close()
+        # Everything up to closing the connection holds frame_lock, so a broadcast can neither interleave
+        # with the last message nor write to the closed connection
+        with self.frame_lock:
+            # Send one more message to the player to let them know they're being removed, just in case
+            send_message(conn, {
+                "type": "end_message", 
+                "content": "You have been removed from the game due to inactivity."
+            })
+            # Find the player of the connection
+            player = self.player_by_conn.pop(conn, None)
+            # Remove the player from the list of players and close the connection
+            if player is not None:
+                self.players.remove(player)
+            self.connections.remove(conn)
+            conn.close()
+        if player is None:
+            return
         # inform all players that a player has been removed
         self.send_message_to_players({
             "type": "player_removed", 
-            "content": "Player " + player["name"] + " has been removed from the game due to inactivity."
+            "content": "Player " + player.name + " has been removed from the game due to inactivity."
         })
 
     # Starts the game and sends start message to all players containing the connection 
     # information to other players
     def start_game(self):
         print("Starting game...")
-
-        # Send start message to all players, requires acknowledgement from all players
-        self.send_message_to_players({
-            "type": "start_message",
-            "content": "Game starts now!",
-            "connections": self.players
-        }, response_type="ack")
-
+        self.send_start_message()
         self.game_ongoing = True
         time.sleep(1)
 
@@ -170,6 +214,14 @@ class BingoHost:
         while self.game_ongoing:
             self.initiate_game_loop()
 
+    # Send start message to all players, requires acknowledgement from all players
+    def send_start_message(self):
+        self.send_message_to_players({
+            "type": "start_message",
+            "content": "Game starts now!",
+            "connections": [player.as_tuple() for player in self.players]
+        }, response_type="ack")
+
     # Initiates the game loop
     def initiate_game_loop(self):
         self.draw_numbers_async()
@@ -189,12 +241,20 @@ class BingoHost:
         while self.numbers:
             if self.bingo_shouted_event.is_set():
                 break
-            number = self.numbers.pop(0)
-            self.drawn_numbers.append(number)
-            print("Number drawn: ", number)
-            self.send_message_to_players({"type": "bingo_number", "number": number})
+            self.draw_number()
             time.sleep(1)
-        # If all numbers have been drawn and no bingo has been shouted, end the game
+        self.check_numbers_exhausted()
+
+    # Draws the next number and sends it to all players
+    def draw_number(self):
+        number = self.numbers.pop(0)
+        self.drawn_numbers.add(number)
+        print("Number drawn: ", number)
+        self.send_message_to_players({"type": "bingo_number", "number": number})
+        return number
+
+    # If all numbers have been drawn and no bingo has been shouted, end the game
+    def check_numbers_exhausted(self):
         if not self.bingo_shouted_event.is_set() and not self.numbers:
             self.end_game("All numbers drawn, no winner this round :(")
 
@@ -205,21 +265,22 @@ class BingoHost:
     # 4th column (G) numbers between 46-60
     # 5th column (O) numbers between 61-75
     def generate_bingo_card(self):
-        bingo_card = []
+        rows = []
         for i in range(1, 76, 15):  # Adjusting the range for each row
             numbers = random.sample(range(i, i + 15), 5)
-            bingo_card.append(numbers)
-        print("Generated a new bingo card: ", bingo_card)
-        self.bingo_cards.append(bingo_card)
+            rows.append(numbers)
+        print("Generated a new bingo card: ", rows)
+        bingo_card = BingoCard(rows)
+        self.bingo_cards[BingoCard.key(rows)] = bingo_card
         return bingo_card
 
     # Listens for messages from a single player
     def listen_to_player(self, conn):
         conn.settimeout(1) # Set connection timeout to 1 second in order to regularly check if a bingo has been shouted
+        reader = self.player_by_conn[conn].reader
         while not self.bingo_shouted_event.is_set() and self.game_ongoing:
             try:
-                data = conn.recv(1024)
-                data = pickle.loads(data)
+                data = reader.recv_message()
                 print("Received message from player: ", data)
                 if data["type"] == "bingo":
                     self.handle_bingo_shouted(data)
@@ -252,10 +313,7 @@ class BingoHost:
             listen_thread.start()
 
     def handle_bingo(self):
-        self.send_message_to_players({
-            "type": "bingo_check",
-            "content": self.bingo["player"] + " shouted bingo! Checking if it's a bingo..."
-        })
+        self.announce_bingo()
         bingo_row = self.get_bingo_row(self.bingo["card"])
         if bingo_row is not None:
             # Consensus round - ask all players if they agree it's a bingo
@@ -264,6 +322,14 @@ class BingoHost:
         else:
             self.handle_non_bingo()
 
+    # Informs all players that a bingo was shouted
+    # The bingo_check message is flushed together with the consensus round or rejection that follows it
+    def announce_bingo(self):
+        self.send_message_to_players({
+            "type": "bingo_check",
+            "content": self.bingo["player"] + " shouted bingo! Checking if it's a bingo..."
+        }, flush=False)
+
     # Handles consensus round result
     # If consenseus is reached, inform all players that it's a bingo and end the game
     # Otherwise inform all players that it's not a bingo and resume the game
@@ -298,50 +364,53 @@ class BingoHost:
         self.game_ongoing = False
 
         # Wait for threads to complete before closing connections
-        for thread in threading.enumerate():
-            if thread != threading.current_thread():
-                thread.join()
+        self.join_threads()
 
         for conn in self.connections:
             conn.close()
         self.socket.close()
 
+    # Waits for all other threads to finish
+    def join_threads(self):
+        for thread in threading.enumerate():
+            if thread != threading.current_thread():
+                thread.join()
+
     # Checks if the card has a bingo. If a bingo is found, return the numbers that form the bingo
     # A bingo is when a row, column or diagonal has all numbers hit
     def get_bingo_row(self, card):
         # if the card is not in the list of bingo cards, it's not a valid bingo
-        if card not in self.bingo_cards:
+        bingo_card = self.bingo_cards.get(BingoCard.key(card))
+        if bingo_card is None:
             print("Card not found in the list of bingo cards, not a valid bingo.")
             return None
-        # check rows
-        for row in card:
-            if all(number in self.drawn_numbers for number in row):
-                return row
-        # check columns
-        for i in range(5):
-            if all(row[i] in self.drawn_numbers for row in card):
-                return [row[i] for row in card]
-        # check diagonals
-        if all(card[i][i] in self.drawn_numbers for i in range(5)):
-            return [card[i][i] for i in range(5)]
-        if all(card[i][4-i] in self.drawn_numbers for i in range(5)):
-            return [card[i][4-i] for i in range(5)]
-        print("No bingo found.")
-        return None
+        bingo_row = bingo_card.bingo_line(self.drawn_numbers.mask)
+        if bingo_row is None:
+            print("No bingo found.")
+        return bingo_row
 
     # Handles consensus round
     # Returns true if consensus is reached, false otherwise
     def is_consensus(self, bingo_row):
-        self.send_message_to_players({  
-                "type": "consensus_round",
-                "numbers": bingo_row
-            }, response_type="consensus_response")
+        self.start_consensus_round(bingo_row)
 
         # Wait for all responses to arrive
         while True:
             if len(self.consensus) == len(self.connections):
                 break
 
+        return self.count_consensus()
+
+    # Asks all players if they agree the row is a bingo
+    def start_consensus_round(self, bingo_row):
+        self.send_message_to_players({  
+                "type": "consensus_round",
+                "numbers": bingo_row
+            }, response_type="consensus_response")
+
+    # Counts the consensus responses and resets them for the next round
+    # Returns true if consensus is reached, false otherwise
+    def count_consensus(self):
         # Count the number of true and false values in the consensus dictionary
         true_count = sum(value for value in self.consensus.values() if value)
         false_count = sum(not value for value in self.consensus.values() if not value)
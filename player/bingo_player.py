@@ -1,82 +1,122 @@
 import datetime
 from socket import *
-import pickle
+import os
 import sys
 import argparse
 import threading
 import time
 import random
 
+# The wire format is shared with the host
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "shared"))
+from bingo_protocol import BingoCard, DrawLog, FrameReader, encode_frame, send_frames, send_message
+
+# Compact record of another player in the game
+# Holds the sockets to the peer and a bitmap of the numbers the peer has hit,
+# bit n is set when the peer has marked number n
+# Writes to the peer socket come from several threads and must hold send_lock
+class PeerRecord:
+    __slots__ = ("address", "client_port", "server_port", "name", "hit_numbers", "peer_socket", "conn", "reader",
+                 "send_lock")
+
+    def __init__(self, address, client_port, server_port, name):
+        self.address = address
+        self.client_port = client_port
+        self.server_port = server_port
+        self.name = name
+        self.hit_numbers = 0
+        self.peer_socket = None
+        self.conn = None
+        self.reader = None
+        self.send_lock = threading.Lock()
+
+    # Creates a record from the wire format sent by the host
+    @classmethod
+    def from_tuple(cls, data):
+        return cls(*data)
+
+    # Key used to match an incoming connection to the peer
+    def key(self):
+        return (self.address, self.server_port)
+
+    def __repr__(self):
+        return f"PeerRecord({self.name!r}, {self.address}:{self.server_port})"
+
 # The player node class
 class Player:
     # Constructor
     # Takes the host and port of the host as arguments
-    def __init__(self, host="", port=65432):
+    # The player is asked for their name unless it is given
+    def __init__(self, host="", port=65432, name=None):
         self.host = ""
         self.port = random.randint(49152, 65534) # Pick a random port between 49152 and 65534
         self.bingo_host = host
         self.bingo_host_port = port
-        self.socket = socket(AF_INET, SOCK_STREAM)
-        self.server_socket = socket(AF_INET, SOCK_STREAM)
-        self.peer_sockets = []
+        self.socket = self.create_socket()
+        self.server_socket = self.create_socket()
         self.players = []
+        self.player_by_key = {}
+        self.player_by_conn = {}
         self.connections = []
-        self.drawn_numbers = []
-        self.bingo_card = []
+        self.drawn_numbers = DrawLog()
+        self.bingo_card = None
+        self.hit_numbers = 0
         self.game_over = False
         self.bingo_shouted_event = threading.Event()
-        print("What's your name?")
-        self.name = input()
-        self.player = {
-            "address": "", 
-            "client_port": "", 
-            "server_port": self.port, 
-            "name": self.name,
-            "hit_numbers": []
-        }
+        if name is None:
+            print("What's your name?")
+            name = input()
+        self.name = name
+        self.player = None
         self.launch()
 
+    # Creates a socket for the connection to the host or to other players
+    def create_socket(self):
+        return socket(AF_INET, SOCK_STREAM)
+
     def launch(self):
         # Connect to the host
         print("Connecting to host: ", self.bingo_host, self.bingo_host_port)
         self.socket.connect((self.bingo_host, self.bingo_host_port))
         # Register with the host
         self.register()
+        reader = FrameReader(self.socket)
         while not self.game_over:
-            data = self.socket.recv(1024)
-            data = pickle.loads(data)
-            # Message from the host that the player has been accepted
-            if data["type"] == "accept_player":
-                self.handle_registration_accepted(data)
-            # Message from the host that the game is starting
-            elif data["type"] == "start_message":
-                self.handle_game_start(data)
-            # Message from the host that a new number has been drawn
-            elif data["type"] == "bingo_number":
-                self.handle_bingo_number(data)
-            # Message from the host to check the consensus on a bingo
-            elif data["type"] == "consensus_round":
-                self.handle_consensus_round(data)
-            # Message from the host that a player has been removed from the game
-            elif data["type"] == "remove_player":
-                self.handle_remove_player(data)
-            # Message from the host that a bingo was shouted
-            elif data["type"] == "bingo_check":
-                self.bingo_shouted_event.set()
-                print(data["content"])
-            # Message from the host that a bingo was rejected 
-            elif data["type"] == "rejected_bingo":
-                self.bingo_shouted_event.clear()
-                print(data["content"])
-            # Message from the host that the game is over
-            elif data["type"] == "end_message":
-                self.handle_end_message(data)
-                break                
-            # else if there is content field in data, print content
-            elif "content" in data:
-                print(data["content"])
-            else:
-                print("Unknown message type: ", data["type"])
+            self.handle_host_message(reader.recv_message())
+
+    # Handles a message from the host
+    def handle_host_message(self, data):
+        # Message from the host that the player has been accepted
+        if data["type"] == "accept_player":
+            self.handle_registration_accepted(data)
+        # Message from the host that the game is starting
+        elif data["type"] == "start_message":
+            self.handle_game_start(data)
+        # Message from the host that a new number has been drawn
+        elif data["type"] == "bingo_number":
+            self.handle_bingo_number(data)
+        # Message from the host to check the consensus on a bingo
+        elif data["type"] == "consensus_round":
+            self.handle_consensus_round(data)
+        # Message from the host that a player has been removed from the game
+        elif data["type"] == "remove_player":
+            self.handle_remove_player(data)
+        # Message from the host that a bingo was shouted
+        elif data["type"] == "bingo_check":
+            self.bingo_shouted_event.set()
+            print(data["content"])
+        # Message from the host that a bingo was rejected 
+        elif data["type"] == "rejected_bingo":
+            self.bingo_shouted_event.clear()
+            print(data["content"])
+        # Message from the host that the game is over
+        elif data["type"] == "end_message":
+            self.handle_end_message(data)
+        # else if there is content field in data, print content
+        elif "content" in data:
+            print(data["content"])
+        else:
+            print("Unknown message type: ", data["type"])
 
     # Send a registration message to the host containing the player's address,
     # name and the ports (server + client) the player is listening on
@@ -87,15 +127,13 @@ class Player:
             return
 
         print("Sending registration message")
-        print("player: ", self.player)
-        self.socket.sendall(
-            pickle.dumps({"type": "register", "player": self.player})
-        )
+        print("player: ", self.name, self.port)
+        send_message(self.socket, {"type": "register", "name": self.name, "server_port": self.port})
 
     # Handles registration accepted message and stores the bingo card
     def handle_registration_accepted(self, data):
-        self.bingo_card = data["card"]  
-        self.socket.sendall(pickle.dumps({"type": "ack"}))
+        self.bingo_card = BingoCard(data["card"])
+        send_message(self.socket, {"type": "ack"})
         print("Registration accepted, here's your bingo card: ")
         self.player = data["player"]
         self.print_card()
@@ -109,36 +147,70 @@ class Player:
         connection_thread.start()
 
     # Establish connections with other players
+    # Each peer introduces itself with the identity the host assigned to it, so the connection can be mapped to the peer
     def establish_connections_with_players(self):
         while len(self.connections) < len(self.players): # Wait until all players have connected
             print("Accepting connections from other players")
             conn, addr = self.server_socket.accept()
-            self.connections.append(conn)
-            print("Connection established with: ", addr)
+            # A peer that does not introduce itself in time is dropped instead of blocking the accept loop
+            conn.settimeout(3)
+            reader = FrameReader(conn)
+            try:
+                data = reader.recv_message()
+            except (timeout, EOFError):
+                print("No introduction received, closing: ", addr)
+                conn.close()
+                continue
+            self.add_peer_connection(conn, addr, reader, data)
         print("All players connected")
 
+    # Maps a connection accepted from another player to the player, based on its peer_hello message
+    # Returns the player, or None if the connection does not belong to any player in the game
+    # A peer that has not been accepted by the host yet has no identity and is treated as unknown
+    def add_peer_connection(self, conn, addr, reader, data):
+        player = None
+        if data["type"] == "peer_hello" and data["player"] is not None:
+            player = self.player_by_key.get(PeerRecord.from_tuple(data["player"]).key())
+        if player is None:
+            print("Connection from unknown player, closing: ", addr)
+            conn.close()
+            return None
+        player.conn = conn
+        player.reader = reader
+        self.player_by_conn[conn] = player
+        self.connections.append(conn)
+        print("Connection established with: ", addr)
+        return player
+
     # Handles game start message
     # Establishes connections with other players and start listening to them asynchronously
     # Starts a thread that regularly sends a sync request to other players
     # Sends an ack message to the host
     def handle_game_start(self, data):
         print(data["content"])
-        self.players = data["connections"]
-        self.players.remove(self.player)
+        self.players = [PeerRecord.from_tuple(player) for player in data["connections"] if tuple(player) != self.player]
+        self.player_by_key = {player.key(): player for player in self.players}
         print("Other players: ", self.players)
         self.establish_server()
         self.connect_other_players()
         self.start_request_sync_thread()
         self.listen_to_players_async()
-        self.socket.sendall(pickle.dumps({"type": "ack"}))
+        send_message(self.socket, {"type": "ack"})
 
     # Connect to other players
     def connect_other_players(self):
         for player in self.players:
-            peer_socket = socket(AF_INET, SOCK_STREAM)
-            self.peer_sockets.append(peer_socket)
-            print("Connecting to ", player["address"], player["server_port"])
-            peer_socket.connect((player["address"], player["server_port"]))
+            peer_socket = self.create_socket()
+            player.peer_socket = peer_socket
+            print("Connecting to ", player.address, player.server_port)
+            peer_socket.connect((player.address, player.server_port))
+            self.send_to_peer(player, encode_frame({"type": "peer_hello", "player": self.player}))
+
+    # Sends an encoded frame to another player
+    # The lock keeps frames from the sync, listening and main threads from interleaving on the socket
+    def send_to_peer(self, player, frame):
+        with player.send_lock:
+            send_frames(player.peer_socket, list(frame))
 
     # Listens to other players asynchronously
     def listen_to_players_async(self):
@@ -149,41 +221,42 @@ class Player:
     # Listens for messages from an individual player
     def listen_to_player(self, conn):
         conn.settimeout(1) # Set connection timeout to 1 second in order to regularly check if a bingo has been shouted
+        reader = self.player_by_conn[conn].reader
         while not self.game_over:
             try:
-                data = conn.recv(1024)
-                data = pickle.loads(data)
-                # Sync request from other player
-                if data["type"] == "sync_request":
-                    self.handle_sync_request(conn, data)
-                # Sync response from other player
-                if data["type"] == "sync_response":
-                    self.handle_sync_response(conn, data)
-                # Number marked message from other player
-                if data["type"] == "number_marked":
-                    self.handle_number_marked(conn, data)
+                self.handle_peer_message(conn, reader.recv_message())
             except timeout:
                 continue
 
+    # Handles a message from another player
+    def handle_peer_message(self, conn, data):
+        # Sync request from other player
+        if data["type"] == "sync_request":
+            self.handle_sync_request(conn, data)
+        # Sync response from other player
+        if data["type"] == "sync_response":
+            self.handle_sync_response(conn, data)
+        # Number marked message from other player
+        if data["type"] == "number_marked":
+            self.handle_number_marked(conn, data)
+
     # Handles bingo number message
     # Adds the number to the drawn numbers and checks if it's a hit
     # If it's a hit, send the number to all other players
     # Checks if the card has a bingo and sends a bingo message to the host if it does
     def handle_bingo_number(self, data):
         print("Number drawn: ", data["number"])
-        self.drawn_numbers.append(data["number"])
+        self.drawn_numbers.add(data["number"])
         # self.send_numbers_to_peers()
         self.check_number(data["number"])
         is_bingo = self.check_bingo()
         if is_bingo:
-            self.socket.sendall(
-                pickle.dumps({
-                    "type": "bingo",
-                    "card": self.bingo_card,
-                    "timestamp": datetime.datetime.now(),
-                    "player": self.name
-                })
-            )
+            send_message(self.socket, {
+                "type": "bingo",
+                "card": self.bingo_card.rows,
+                "timestamp": datetime.datetime.now(),
+                "player": self.name
+            })
             print("BINGO!")
             self.print_card()
 
@@ -200,38 +273,39 @@ class Player:
         while not self.game_over and not self.bingo_shouted_event.is_set():
             time.sleep(interval)
             if not self.bingo_shouted_event.is_set():
-                print("Sending sync request to all peers...")
-                for peer_socket in self.peer_sockets:
-                    peer_socket.sendall(
-                        pickle.dumps({
-                            "type": "sync_request",
-                            "timestamp": datetime.datetime.now(),
-                        })
-                        )
+                self.send_sync_request()
+
+    # Sends a sync request to all other players
+    def send_sync_request(self):
+        print("Sending sync request to all peers...")
+        frame = encode_frame({
+            "type": "sync_request",
+            "timestamp": datetime.datetime.now(),
+        })
+        for player in self.players:
+            self.send_to_peer(player, frame)
 
     # Handles sync request message
     # Sends the drawn numbers to the peer
     def handle_sync_request(self, conn, data):
-        # Find peer socket based on the connection
-        peer_socket = self.peer_sockets[self.connections.index(conn)]
+        # Find the peer based on the connection
+        player = self.player_by_conn[conn]
 
-        peer_socket.sendall(
-            pickle.dumps({
-                "type": "sync_response",
-                "numbers": self.drawn_numbers,
-                "timestamp": datetime.datetime.now(),
-            })
-        )
+        self.send_to_peer(player, encode_frame({
+            "type": "sync_response",
+            "numbers": self.drawn_numbers.to_bytes(),
+            "timestamp": datetime.datetime.now(),
+        }))
 
     # Handles sync response message
     # Checks if the drawn numbers are the same as the peer's drawn numbers
     def handle_sync_response(self, conn, data):
         peer_numbers = data["numbers"]
-        is_ok = len(peer_numbers) == len(self.drawn_numbers) and peer_numbers == self.drawn_numbers
+        is_ok = len(peer_numbers) == len(self.drawn_numbers) and peer_numbers == self.drawn_numbers.to_bytes()
         if not is_ok:
             print("Sync mismatch. Syncing numbers with peer: ", conn.getpeername())
             # Combine the drawn numbers with the peer's drawn numbers
-            self.drawn_numbers = list(set(self.drawn_numbers + peer_numbers))
+            self.drawn_numbers.merge(peer_numbers)
 
     # Handles end message
     # Closes all connections and sockets
@@ -239,56 +313,63 @@ class Player:
         self.game_over = True
         print(data["content"])
 
-        for thread in threading.enumerate():
-            if thread != threading.current_thread():
-                thread.join()
+        self.join_threads()
 
         for conn in self.connections:
             conn.close()
 
-        for peer_socket in self.peer_sockets:
-            peer_socket.close()
+        for player in self.players:
+            player.peer_socket.close()
 
         self.socket.close()
 
+    # Waits for all other threads to finish
+    def join_threads(self):
+        for thread in threading.enumerate():
+            if thread != threading.current_thread():
+                thread.join()
+
     # Checks if the given number is in the card
     # If it is, adds it to the player's hit numbers and sends a message to all other players
+    # Numbers drawn before the player has received a card are not hits
     def check_number(self, number):
-        for row in self.bingo_card:
-            if number in row:
-                self.player["hit_numbers"].append(number)
-                if not self.bingo_shouted_event.is_set():
-                    self.send_hit(number)
-                print("IT'S A HIT: ", number)
-                self.print_card()
-                return True
+        if self.bingo_card is None:
+            return False
+        if number in self.bingo_card:
+            self.hit_numbers |= 1 << number
+            if not self.bingo_shouted_event.is_set():
+                self.send_hit(number)
+            print("IT'S A HIT: ", number)
+            self.print_card()
+            return True
         return False
 
     # Sends a message to all other players that the given number was a hit
     def send_hit(self, number):
-        for peer_socket in self.peer_sockets:
-            peer_socket.sendall(
-                pickle.dumps({
-                    "type": "number_marked",
-                    "number": number,
-                    "player": self.name
-                })
-            )
+        frame = encode_frame({
+            "type": "number_marked",
+            "number": number,
+            "player": self.name
+        })
+        for player in self.players:
+            self.send_to_peer(player, frame)
 
     # Handles number marked message
     # Sends the number to all other players and adds it to the player's hit numbers
     def handle_number_marked(self, conn, data):
         # Get player based on the connection
-        player = self.players[self.connections.index(conn)]
-        print("Player", player["name"], "hit number:", data["number"])
+        player = self.player_by_conn[conn]
+        print("Player", player.name, "hit number:", data["number"])
         # Add the number to the player's hit numbers
-        player["hit_numbers"].append(data["number"])
+        player.hit_numbers |= 1 << data["number"]
 
     # Prints card in a form where each row is a vertical column
     def print_card(self):
+        if self.bingo_card is None:
+            return
         print("B\tI\tN\tG\tO")
         for i in range(5):
-            for row in self.bingo_card:
+            for row in self.bingo_card.rows:
                 # if the number has been drawn, print the number in red
                 if row[i] in self.drawn_numbers:
                     print("\033[91m{}\033[00m".format(row[i]), end="\t")
@@ -298,48 +379,37 @@ class Player:
 
     # Checks if the card has a bingo. A bingo is when a row, column or diagonal has all numbers hit
     def check_bingo(self):
-        # check rows
-        for row in self.bingo_card:
-            if all(number in self.drawn_numbers for number in row):
-                return True
-        # check columns
-        for i in range(5):
-            if all(row[i] in self.drawn_numbers for row in self.bingo_card):
-                return True
-        # check diagonals
-        if all(self.bingo_card[i][i] in self.drawn_numbers for i in range(5)):
-            return True
-        if all(self.bingo_card[i][4-i] in self.drawn_numbers for i in range(5)):
-            return True
-        return False
+        if self.bingo_card is None:
+            return False
+        return self.bingo_card.has_bingo(self.drawn_numbers.mask)
 
     # Handles consensus round message
     # If the row is a subset of the drawn numbers, sends a consensus response that the row is a bingo
     def handle_consensus_round(self, data):
         bingo_row = data["numbers"]
         print("Checking consensus on row: ", bingo_row)
-        is_bingo = set(bingo_row).issubset(set(self.drawn_numbers))
+        is_bingo = self.drawn_numbers.has_all(bingo_row)
         print("Sending consensus response. Is bingo: ", is_bingo)
-        self.socket.sendall(
-            pickle.dumps({
-                "type": "consensus_response",
-                "is_bingo": is_bingo,
-                "timestamp": datetime.datetime.now(),
-            })
-        )
+        send_message(self.socket, {
+            "type": "consensus_response",
+            "is_bingo": is_bingo,
+            "timestamp": datetime.datetime.now(),
+        })
         print("Consensus response sent")
     
     # Handles remove player message
     # Removes the player from the list of players and closes the connection
     def handle_remove_player(self, data):
         print("Removing player: ", data["player"])
-        self.players.remove(data["player"])
-        peer_socket = self.peer_sockets[self.players.index(data["player"])]
-        peer_socket.close()
-        self.peer_sockets.remove(peer_socket)
-        connection = self.connections[self.players.index(data["player"])]
-        connection.close()
-        self.connections.remove(connection)
+        player = self.player_by_key.pop(PeerRecord.from_tuple(data["player"]).key(), None)
+        if player is None:
+            return
+        self.players.remove(player)
+        player.peer_socket.close()
+        if player.conn is not None:
+            self.player_by_conn.pop(player.conn, None)
+            player.conn.close()
+            self.connections.remove(player.conn)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
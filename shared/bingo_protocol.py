@@ -0,0 +1,140 @@
+# Wire format and game state shared by the bingo host and the players
+# Both sides have to agree on the framing, so it is kept in this one module
+from array import array
+import pickle
+import struct
+import threading
+
+# Frames are a 4 byte big-endian payload length followed by the pickled message
+FRAME_HEADER = struct.Struct("!I")
+# Maximum number of buffers handed to a single sendmsg call
+IOV_MAX = 1024
+
+# Encodes a message once into an immutable frame
+# Returns memoryviews of the header and payload, which can be shared by every connection
+def encode_frame(message):
+    payload = pickle.dumps(message)
+    return (memoryview(FRAME_HEADER.pack(len(payload))), memoryview(payload))
+
+# Writes the pending buffers to the socket with vectored sendmsg calls
+# Fully written buffers are removed from the list, a partially written one is trimmed
+def send_frames(conn, pending):
+    # socket.sendmsg does not exist on Windows, send the joined buffers in one sendall there
+    if not hasattr(conn, "sendmsg"):
+        conn.sendall(b"".join(pending))
+        pending.clear()
+        return
+    while pending:
+        sent = conn.sendmsg(pending[:IOV_MAX])
+        written = 0
+        while written < len(pending) and sent >= len(pending[written]):
+            sent -= len(pending[written])
+            written += 1
+        del pending[:written]
+        if sent:
+            pending[0] = pending[0][sent:]
+
+# Encodes and sends a single message to one socket
+def send_message(conn, message):
+    send_frames(conn, list(encode_frame(message)))
+
+# Reads length-prefixed frames from a socket
+# Bytes of an incomplete frame are kept between calls, so a timeout does not lose data
+# The host reads a player's connection from more than one thread, so reads are serialised by lock
+class FrameReader:
+    __slots__ = ("conn", "buffer", "lock")
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.buffer = bytearray()
+        self.lock = threading.Lock()
+
+    # Returns the next message, raises timeout if the socket times out before a full frame arrives
+    def recv_message(self):
+        with self.lock:
+            while True:
+                if len(self.buffer) >= FRAME_HEADER.size:
+                    (length,) = FRAME_HEADER.unpack_from(self.buffer)
+                    end = FRAME_HEADER.size + length
+                    if len(self.buffer) >= end:
+                        message = pickle.loads(self.buffer[FRAME_HEADER.size:end])
+                        del self.buffer[:end]
+                        return message
+                data = self.conn.recv(4096)
+                if not data:
+                    raise EOFError("Connection closed by peer")
+                self.buffer += data
+
+# Bingo card with precomputed bitmaps of every winning line
+# Bit n of a mask is set when number n is part of the line
+class BingoCard:
+    __slots__ = ("rows", "mask", "lines")
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.mask = 0
+        for row in rows:
+            for number in row:
+                self.mask |= 1 << number
+        # rows, columns and diagonals, in the order they are checked
+        lines = [list(row) for row in rows]
+        lines += [[row[i] for row in rows] for i in range(5)]
+        lines.append([rows[i][i] for i in range(5)])
+        lines.append([rows[i][4-i] for i in range(5)])
+        self.lines = tuple((sum(1 << number for number in line), line) for line in lines)
+
+    # Key used to look up a card sent back by a player
+    @staticmethod
+    def key(rows):
+        return tuple(tuple(row) for row in rows)
+
+    # Returns the first line fully covered by the drawn numbers, or None
+    def bingo_line(self, drawn_mask):
+        for line_mask, line in self.lines:
+            if drawn_mask & line_mask == line_mask:
+                return line
+        return None
+
+    # Returns true if any line is fully covered by the drawn numbers
+    def has_bingo(self, drawn_mask):
+        return self.bingo_line(drawn_mask) is not None
+
+    def __contains__(self, number):
+        return self.mask >> number & 1 == 1
+
+# Log of drawn numbers
+# Keeps the draw order in a byte array and the set of drawn numbers in a bitmap
+class DrawLog:
+    __slots__ = ("order", "mask")
+
+    def __init__(self):
+        self.order = array("B")
+        self.mask = 0
+
+    # Adds a number to the log, returns False if it was already drawn
+    def add(self, number):
+        bit = 1 << number
+        if self.mask & bit:
+            return False
+        self.mask |= bit
+        self.order.append(number)
+        return True
+
+    # Adds the numbers missing from the log, keeping the order they were received in
+    def merge(self, numbers):
+        for number in numbers:
+            self.add(number)
+
+    # Returns true if all the given numbers have been drawn
+    def has_all(self, numbers):
+        return all(self.mask >> number & 1 for number in numbers)
+
+    # Draw order as bytes, used as the wire format in sync responses
+    def to_bytes(self):
+        return self.order.tobytes()
+
+    def __contains__(self, number):
+        return self.mask >> number & 1 == 1
+
+    def __len__(self):
+        return len(self.order)
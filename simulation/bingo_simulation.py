@@ -0,0 +1,514 @@
+from socket import timeout
+import argparse
+import collections
+import contextlib
+import heapq
+import itertools
+import math
+import os
+import random
+import sys
+import time
+
+# The host and player scripts live in their own directories
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "shared"))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "player"))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bingo_host"))
+from bingo_protocol import FrameReader
+import bingo_host
+import bingo_player
+
+HOST_ADDRESS = "192.168.0.1"
+# Time between the start message and the game loop, as in BingoHost.start_game
+START_DELAY = 1
+# Time between drawn numbers, as in BingoHost.draw_numbers
+DRAW_INTERVAL = 1
+# Interval at which BingoHost.initiate_game_loop checks whether a bingo has been shouted
+POLL_INTERVAL = 1
+# Retransmission timeout of a lost write, doubled for every further loss of the same write
+# 200ms is the minimum retransmission timeout of TCP on Linux
+RETRANSMISSION_TIMEOUT = 0.2
+# Time before a player that has not responded is removed, as in BingoHost.wait_for_response (3 retries of 3 seconds)
+RESPONSE_TIMEOUT = 3 * 3
+
+# Reads all complete messages buffered on a virtual socket and passes them to the handler
+# An error raised by the handler crashes the node that owns the socket, not the simulation
+def pump_messages(node, conn, reader, handler):
+    while not conn.closed and (conn.inbox or reader.buffer):
+        try:
+            data = reader.recv_message()
+        except timeout:
+            return
+        node.simulation.messages[data["type"]] += 1
+        try:
+            handler(conn, data)
+        except Exception as error:
+            node.crash(error)
+            return
+
+# In-memory socket with the parts of the socket API used by the host and the players
+# Instead of blocking on recv, the owner sets on_readable (and on_accept for listening sockets)
+# and is called back by the network when data or a connection arrives
+class VirtualSocket:
+    __slots__ = ("network", "address", "local", "remote", "peer", "inbox", "closed",
+                 "last_arrival", "on_readable", "on_accept")
+
+    def __init__(self, network, address):
+        self.network = network
+        self.address = address
+        self.local = None
+        self.remote = None
+        self.peer = None
+        self.inbox = bytearray()
+        self.closed = False
+        self.last_arrival = 0.0
+        self.on_readable = None
+        self.on_accept = None
+
+    def bind(self, addr):
+        self.local = (self.address, addr[1])
+
+    def listen(self, backlog=None):
+        self.network.listen(self)
+
+    # Connections to ports that are not listening yet wait in a backlog instead of being refused
+    def connect(self, addr):
+        self.network.connect(self, addr)
+
+    def sendmsg(self, buffers):
+        if self.closed:
+            raise OSError("Send on a closed virtual socket")
+        data = b"".join(buffers)
+        self.network.transmit(self, data)
+        return len(data)
+
+    # Raises timeout when there is nothing to read, like a socket with a timeout set
+    def recv(self, size):
+        if not self.inbox:
+            raise timeout("No data on virtual socket")
+        data = bytes(self.inbox[:size])
+        del self.inbox[:size]
+        return data
+
+    def settimeout(self, value):
+        pass
+
+    def getpeername(self):
+        return self.remote
+
+    def close(self):
+        self.closed = True
+        self.network.close(self)
+
+# Network between virtual sockets
+# Every write is delivered as one unit after a random latency and may skip the in-order delivery
+# of its connection with probability reorder
+# The connections are streams like TCP, so a write is never dropped: with probability loss each
+# transmission is lost and the write arrives one retransmission timeout later, holding back the
+# writes after it on the same connection
+class VirtualNetwork:
+    def __init__(self, simulation, latency=(0.001, 0.01), loss=0.0, reorder=0.0):
+        self.simulation = simulation
+        self.latency = latency
+        self.loss = loss
+        self.reorder = reorder
+        self.listeners = {}
+        self.backlog = collections.defaultdict(list)
+        self.ports = collections.Counter()
+        self.bytes_sent = 0
+        self.retransmissions = 0
+
+    def socket(self, address):
+        return VirtualSocket(self, address)
+
+    def delay(self):
+        return self.simulation.rng.uniform(*self.latency)
+
+    def listen(self, sock):
+        self.listeners[sock.local] = sock
+        for conn in self.backlog.pop(sock.local, ()):
+            self.simulation.schedule(self.delay(), self.accept, sock, conn)
+
+    def connect(self, sock, addr):
+        # Pick an ephemeral port for the client side
+        self.ports[sock.address] += 1
+        sock.local = (sock.address, 32768 + self.ports[sock.address])
+        sock.remote = tuple(addr)
+        conn = VirtualSocket(self, addr[0])
+        conn.local = sock.remote
+        conn.remote = sock.local
+        sock.peer = conn
+        conn.peer = sock
+        listener = self.listeners.get(sock.remote)
+        if listener is None:
+            self.backlog[sock.remote].append(conn)
+        else:
+            self.simulation.schedule(self.delay(), self.accept, listener, conn)
+
+    def accept(self, listener, conn):
+        if listener.closed:
+            return
+        listener.on_accept(conn, conn.remote)
+        # Data sent before the connection was accepted is already waiting in the inbox
+        if conn.inbox and conn.on_readable is not None:
+            conn.on_readable(conn)
+
+    def transmit(self, sock, data):
+        self.bytes_sent += len(data)
+        rng = self.simulation.rng
+        arrival = self.simulation.now + self.delay()
+        retransmission_timeout = RETRANSMISSION_TIMEOUT
+        while self.loss and rng.random() < self.loss:
+            self.retransmissions += 1
+            arrival += retransmission_timeout
+            retransmission_timeout *= 2
+        if not (self.reorder and rng.random() < self.reorder):
+            # Keep the connection in order unless this write is reordered
+            arrival = max(arrival, sock.last_arrival)
+            sock.last_arrival = arrival
+        self.simulation.schedule(arrival - self.simulation.now, self.deliver, sock.peer, data)
+
+    def deliver(self, conn, data):
+        if conn.closed:
+            return
+        conn.inbox += data
+        if conn.on_readable is not None:
+            conn.on_readable(conn)
+
+    def close(self, sock):
+        if self.listeners.get(sock.local) is sock:
+            del self.listeners[sock.local]
+
+# Bingo host running on the virtual network
+# Registration, drawing and waiting for responses are driven by simulation events instead of
+# blocking loops and threads, the message handling is the one of BingoHost
+class SimHost(bingo_host.BingoHost):
+    def __init__(self, simulation, required_players):
+        self.simulation = simulation
+        self.awaiting = {}
+        self.response_tokens = itertools.count()
+        self.draw_round = 0
+        self.round_started_at = 0.0
+        self.consensus_open = False
+        self.bingo_shouted_at = None
+        super().__init__()
+        self.required_players = required_players
+
+    def create_socket(self):
+        return self.simulation.network.socket(HOST_ADDRESS)
+
+    def launch(self):
+        self.initialise_new_game()
+        self.socket.on_accept = self.accept_connection
+
+    def accept_connection(self, conn, addr):
+        reader = FrameReader(conn)
+        conn.on_readable = lambda conn: pump_messages(
+            self, conn, reader, lambda conn, data: self.handle_player_message(conn, reader, addr, data))
+
+    # Handles a message from a player, replacing the listening threads of BingoHost
+    def handle_player_message(self, conn, reader, addr, data):
+        if data["type"] == "register":
+            if not self.registration_open:
+                conn.close()
+                return
+            self.register_player(conn, reader, addr, data)
+            self.expect_response(conn, "accept_player", "ack")
+            if len(self.players) == self.required_players:
+                self.registration_open = False
+                self.start_game()
+        elif data["type"] == "bingo":
+            if self.game_ongoing and self.bingo is None:
+                self.handle_bingo_shouted(data)
+                self.bingo_shouted_at = self.simulation.now
+                self.simulation.schedule(self.next_poll() - self.simulation.now, self.handle_bingo)
+        elif self.awaiting.get(conn, (None,))[0] == data["type"]:
+            del self.awaiting[conn]
+            if data["type"] == "consensus_response":
+                self.consensus[conn.getpeername()] = data["is_bingo"]
+                self.check_consensus_round()
+
+    # Waits for a response from the player without blocking
+    # The player is removed if the response has not arrived within RESPONSE_TIMEOUT
+    def expect_response(self, conn, message_type, response_type):
+        token = next(self.response_tokens)
+        self.awaiting[conn] = (response_type, token)
+        self.simulation.schedule(RESPONSE_TIMEOUT, self.check_response, conn, message_type, token)
+
+    def check_response(self, conn, message_type, token):
+        if self.awaiting.get(conn, (None, None))[1] != token:
+            return
+        del self.awaiting[conn]
+        print(f"No response received for {message_type}.")
+        print(f"Removing player {conn.getpeername()} from the game and closing connection...")
+        self.remove_player(conn)
+        self.check_consensus_round()
+
+    def wait_for_response_from_all(self, message_type, response_type):
+        for conn in self.connections:
+            self.expect_response(conn, message_type, response_type)
+
+    def start_game(self):
+        print("Starting game...")
+        self.send_start_message()
+        self.game_ongoing = True
+        self.simulation.schedule(START_DELAY, self.initiate_game_loop)
+
+    # Starts a new round of draws, draws of earlier rounds are ignored
+    # As in BingoHost.initiate_game_loop, the first number is drawn at once and the host starts
+    # polling for a shouted bingo every POLL_INTERVAL
+    def initiate_game_loop(self):
+        self.draw_round += 1
+        self.round_started_at = self.simulation.now
+        self.draw_next_number(self.draw_round)
+
+    # Time of the next poll of the current round
+    def next_poll(self):
+        polls = math.floor((self.simulation.now - self.round_started_at) / POLL_INTERVAL) + 1
+        return self.round_started_at + polls * POLL_INTERVAL
+
+    def draw_next_number(self, draw_round):
+        if draw_round != self.draw_round or not self.game_ongoing or self.bingo_shouted_event.is_set():
+            return
+        if not self.numbers:
+            self.check_numbers_exhausted()
+            return
+        self.draw_number()
+        self.simulation.schedule(DRAW_INTERVAL, self.draw_next_number, draw_round)
+
+    def handle_bingo(self):
+        if not self.game_ongoing:
+            return
+        self.announce_bingo()
+        bingo_row = self.get_bingo_row(self.bingo["card"])
+        if bingo_row is not None:
+            self.consensus_open = True
+            self.start_consensus_round(bingo_row)
+            self.check_consensus_round()
+        else:
+            self.handle_non_bingo()
+            self.initiate_game_loop()
+
+    # Finishes the consensus round once every remaining player has responded
+    def check_consensus_round(self):
+        if not self.consensus_open or len(self.consensus) < len(self.connections):
+            return
+        self.consensus_open = False
+        self.simulation.consensus_latencies.append(self.simulation.now - self.bingo_shouted_at)
+        self.handle_consensus_round_result(self.count_consensus())
+        if self.game_ongoing:
+            self.initiate_game_loop()
+
+    def end_game(self, message):
+        super().end_game(message)
+        self.simulation.finished = True
+
+    # The simulated host runs no threads of its own, and threads of the calling program must not block the game
+    def join_threads(self):
+        pass
+
+    # A crashed host ends the simulated game
+    def crash(self, error):
+        self.simulation.crashes[f"host {type(error).__name__}: {error}"] += 1
+        self.game_ongoing = False
+        self.simulation.finished = True
+
+# Player running on the virtual network
+# Messages from the host and the other players are handled by the methods of Player when they are
+# delivered, the sync requests are scheduled as simulation events instead of running in a thread
+class SimPlayer(bingo_player.Player):
+    def __init__(self, simulation, address, name, host_address):
+        self.simulation = simulation
+        self.address = address
+        super().__init__(host=host_address[0], port=host_address[1], name=name)
+
+    def create_socket(self):
+        return self.simulation.network.socket(self.address)
+
+    def launch(self):
+        print("Connecting to host: ", self.bingo_host, self.bingo_host_port)
+        self.socket.connect((self.bingo_host, self.bingo_host_port))
+        self.register()
+        reader = FrameReader(self.socket)
+        self.socket.on_readable = lambda conn: pump_messages(
+            self, conn, reader, lambda conn, data: self.handle_host_message(data))
+
+    def establish_server(self):
+        print(f"self.player: {self.player}")
+        self.server_socket.bind(("", self.port))
+        self.server_socket.listen()
+        self.server_socket.on_accept = self.accept_connection
+
+    def accept_connection(self, conn, addr):
+        reader = FrameReader(conn)
+        conn.on_readable = lambda conn: pump_messages(
+            self, conn, reader, lambda conn, data: self.handle_connection_message(conn, addr, reader, data))
+
+    # The first message on a connection from another player is its peer_hello
+    # Like listen_to_player, messages are ignored once the game is over for this player
+    def handle_connection_message(self, conn, addr, reader, data):
+        if self.game_over:
+            return
+        if conn in self.player_by_conn:
+            self.handle_peer_message(conn, data)
+        else:
+            self.add_peer_connection(conn, addr, reader, data)
+
+    def listen_to_players_async(self):
+        pass
+
+    # The simulated player runs no threads of its own, and threads of the calling program must not block the game
+    def join_threads(self):
+        pass
+
+    def start_request_sync_thread(self):
+        interval = random.randint(4, 8)
+        self.simulation.schedule(interval, self.request_sync_once, interval)
+
+    def request_sync_once(self, interval):
+        if self.game_over or self.bingo_shouted_event.is_set():
+            return
+        self.send_sync_request()
+        self.simulation.schedule(interval, self.request_sync_once, interval)
+
+    # A crashed player stops and closes all its sockets, the host notices it by the missing responses
+    def crash(self, error):
+        self.simulation.crashes[f"player {type(error).__name__}: {error}"] += 1
+        self.game_over = True
+        for sock in [self.socket, self.server_socket, *self.connections,
+                     *(player.peer_socket for player in self.players if player.peer_socket is not None)]:
+            sock.close()
+
+# Replaces print in the host and player modules while a game runs quietly
+def silent_print(*args, **kwargs):
+    pass
+
+@contextlib.contextmanager
+def quiet_output():
+    modules = (bingo_host, bingo_player, sys.modules[__name__])
+    for module in modules:
+        module.print = silent_print
+    try:
+        yield
+    finally:
+        for module in modules:
+            del module.print
+
+# Result of a simulated game
+class GameResult:
+    __slots__ = ("seed", "players", "started", "finished", "duration", "numbers_drawn", "winner",
+                 "consensus_latencies", "messages", "crashes", "bytes_sent", "retransmissions", "events")
+
+    def __init__(self, **fields):
+        for name in self.__slots__:
+            setattr(self, name, fields[name])
+
+    def __repr__(self):
+        return (f"GameResult(seed={self.seed!r}, players={self.players}, started={self.started}, finished={self.finished}, "
+                f"duration={self.duration:.2f}, numbers_drawn={self.numbers_drawn}, winner={self.winner!r})")
+
+# Discrete-event simulation of a single game
+# Time is virtual: events run in order of their virtual time, ties in the order they were scheduled.
+# Runs with the same seed and settings give the same game.
+class Simulation:
+    def __init__(self, seed=0, latency=(0.001, 0.01), loss=0.0, reorder=0.0):
+        self.seed = seed
+        self.rng = random.Random(f"network:{seed}")
+        self.now = 0.0
+        self.queue = []
+        self.sequence = itertools.count()
+        self.events = 0
+        self.finished = False
+        self.messages = collections.Counter()
+        self.crashes = collections.Counter()
+        self.consensus_latencies = []
+        self.network = VirtualNetwork(self, latency, loss, reorder)
+
+    # Runs the callback after the given delay of virtual time
+    def schedule(self, delay, callback, *args):
+        heapq.heappush(self.queue, (self.now + delay, next(self.sequence), callback, args))
+
+    # Processes events until the game has ended, no events are left or the time limit is reached
+    def run(self, until):
+        queue = self.queue
+        while queue and not self.finished:
+            when, _, callback, args = queue[0]
+            if when > until:
+                break
+            heapq.heappop(queue)
+            self.now = when
+            self.events += 1
+            callback(*args)
+
+    # Plays one game with the given number of players
+    # The host and players use the global random module, so it is seeded here as well
+    def run_game(self, players, max_time=600, verbose=False):
+        random.seed(f"game:{self.seed}")
+        with contextlib.nullcontext() if verbose else quiet_output():
+            host = SimHost(self, players)
+            for i in range(1, players + 1):
+                address = f"10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}"
+                SimPlayer(self, address, f"player-{i}", (HOST_ADDRESS, host.port))
+            self.run(max_time)
+        return GameResult(
+            seed=self.seed,
+            players=players,
+            started=not host.registration_open,
+            finished=self.finished,
+            duration=self.now,
+            numbers_drawn=len(host.drawn_numbers),
+            winner=host.bingo["player"] if host.bingo and host.bingo["confirmed"] else None,
+            consensus_latencies=self.consensus_latencies,
+            messages=self.messages,
+            crashes=self.crashes,
+            bytes_sent=self.network.bytes_sent,
+            retransmissions=self.network.retransmissions,
+            events=self.events,
+        )
+
+# Plays a number of games, each with its own seed derived from the given seed
+def run_games(games, players, seed=0, **network):
+    return [Simulation(seed=f"{seed}:{game}", **network).run_game(players) for game in range(games)]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--games", type=int, default=100, help="number of games to simulate")
+    parser.add_argument("--players", type=int, default=10, help="number of players per game")
+    parser.add_argument("--seed", default=0, help="seed of the simulation")
+    parser.add_argument("--latency", type=float, nargs=2, default=(0.001, 0.01), help="min and max latency in seconds")
+    parser.add_argument("--loss", type=float, default=0.0, help="probability that a transmission is lost and has to be retransmitted")
+    parser.add_argument("--reorder", type=float, default=0.0, help="probability that a write is delivered out of order")
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    results = run_games(args.games, args.players, seed=args.seed,
+                        latency=tuple(args.latency), loss=args.loss, reorder=args.reorder)
+    elapsed = time.perf_counter() - started
+
+    # Games that never got past registration are counted apart and left out of the averages
+    played = [result for result in results if result.started]
+    messages = collections.Counter()
+    crashes = collections.Counter()
+    latencies = []
+    for result in results:
+        crashes.update(result.crashes)
+    for result in played:
+        messages.update(result.messages)
+        latencies.extend(result.consensus_latencies)
+    print(f"Simulated {len(results)} games with {args.players} players in {elapsed:.2f}s "
+          f"({len(results) / elapsed:.1f} games/s, {sum(result.events for result in results) / elapsed:.0f} events/s)")
+    print(f"Never started: {len(results) - len(played)}, "
+          f"finished: {sum(result.finished for result in played)}, "
+          f"won: {sum(result.winner is not None for result in played)}")
+    if played:
+        print(f"Average numbers drawn: {sum(result.numbers_drawn for result in played) / len(played):.1f}")
+        if latencies:
+            latencies.sort()
+            print(f"Consensus latency from shout to result: median {latencies[len(latencies) // 2] * 1000:.1f}ms, "
+                  f"max {latencies[-1] * 1000:.1f}ms over {len(latencies)} rounds")
+        print(f"Sync traffic per game: {messages['sync_request'] / len(played):.0f} requests, "
+              f"{messages['sync_response'] / len(played):.0f} responses")
+        print(f"Messages per game: {sum(messages.values()) / len(played):.0f}, "
+              f"retransmissions per game: {sum(result.retransmissions for result in played) / len(played):.0f}")
+    for crash, count in crashes.most_common():
+        print(f"Crashed {count} times: {crash}")